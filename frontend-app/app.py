@@ -11,6 +11,7 @@ from google.auth import exceptions as auth_exceptions
 PROJECT_ID = "test-rag-backend-v4" 
 BUCKET_NAME = "ai-empower-rag-v4-uploads" 
 API_URL = "https://rag-retrieval-v4-873142271416.us-central1.run.app/query" 
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # Must be a multiple of 256 KiB
 
 st.set_page_config(page_title="Test Medical RAG V4", layout="wide")
 st.title("Test Medical RAG V4")
@@ -63,9 +64,11 @@ with st.sidebar:
                     # The blob path automatically sets the client_id for the Dispatcher
                     blob_path = f"uploads/{st.session_state.client_id}/{uploaded_file.name}"
                     blob = bucket.blob(blob_path)
+                    # Resumable upload in 8 MiB chunks instead of the 100 MiB default
+                    blob.chunk_size = UPLOAD_CHUNK_SIZE
                     
                     # Upload (triggers Eventarc -> Dispatcher -> Pub/Sub -> Worker)
-                    blob.upload_from_file(uploaded_file, rewind=True)
+                    blob.upload_from_file(uploaded_file, rewind=True, checksum="md5")
                     
                     st.success("Upload Complete! Indexing started (V4 Async Pipeline).")
                     st.info("The document will be searchable in a few minutes.")
@@ -89,26 +92,23 @@ if prompt := st.chat_input("Ask a question about your documents..."):
     with st.chat_message("assistant"):
         with st.spinner(f"Consulting {st.session_state.client_id} knowledge base..."):
             try:
-                # Call the Retrieval API
-                response = requests.post(API_URL, json={
+                # Call the Retrieval API, streaming the answer as it is generated
+                with requests.post(API_URL, json={
                     "query": prompt,
                     "client_id": st.session_state.client_id,
                     # Session ID supports conversational memory
-                    "session_id": st.session_state.session_id 
-                })
+                    "session_id": st.session_state.session_id,
+                    "stream": True
+                }, stream=True) as response:
                 
-                # Handle API Error
-                if response.status_code != 200:
-                    error_data = response.json()
-                    st.error(f"API Error ({response.status_code}): {error_data.get('error', 'Unknown Error')}")
-                    answer = "Error processing request."
-                else:
-                    data = response.json()
-                    answer = data.get("answer", "Error retrieving answer.")
-                    # context_used is retrieved but not displayed as requested.
-                    
-                    # Display Answer
-                    st.markdown(answer)
+                    # Handle API Error
+                    if response.status_code != 200:
+                        error_data = response.json()
+                        st.error(f"API Error ({response.status_code}): {error_data.get('error', 'Unknown Error')}")
+                        answer = "Error processing request."
+                    else:
+                        # Display Answer (rendered incrementally; returns the full text)
+                        answer = st.write_stream(response.iter_content(chunk_size=None, decode_unicode=True))
                                 
                 # 3. Add assistant message to history
                 st.session_state.messages.append({"role": "assistant", "content": answer})
@@ -4,8 +4,7 @@ import json
 import logging
 from google.cloud import storage
 from google.cloud import pubsub_v1
-from pypdf import PdfReader
-from io import BytesIO
+from pdf_reader import read_pdf, count_pages
 
 # Configuration
 PROJECT_ID = os.environ.get("GCP_PROJECT", "test-rag-backend-v4")
@@ -36,16 +35,14 @@ def handle_upload(cloud_event):
 
     logging.info(f"Processing {file_path} for Client: {client_id}")
 
-    # 2. Download to Memory (to count pages)
-    # Note: We only read the metadata/cross-reference table, not the whole text here.
+    # 2. Count pages
+    # Note: Large files are read in cached byte ranges (xref table and page tree root only).
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(file_path)
-    content = blob.download_as_bytes()
     
     try:
         if file_path.endswith(".pdf"):
-            reader = PdfReader(BytesIO(content))
-            total_pages = len(reader.pages)
+            total_pages = read_pdf(blob, count_pages)
         else:
             # Placeholder for PPTX page counting logic
             total_pages = 1 
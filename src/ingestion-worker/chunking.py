@@ -0,0 +1,125 @@
+import re
+import logging
+from collections import deque
+from langchain.text_splitter import RecursiveCharacterTextSplitter, _split_text_with_regex
+
+def batched_char_length(texts):
+    """Character length of each text, measured in a single call."""
+    return [len(t) for t in texts]
+
+class BatchedLengthTextSplitter(RecursiveCharacterTextSplitter):
+    """RecursiveCharacterTextSplitter that measures each level of splits with one
+    batched length call and carries those lengths through the merge step, so no
+    split is measured twice (matters once the length function is a tokenizer)."""
+
+    def __init__(self, batched_length_function=batched_char_length, **kwargs):
+        super().__init__(length_function=lambda text: batched_length_function([text])[0], **kwargs)
+        self._batched_length_function = batched_length_function
+
+    def _split_text(self, text, separators):
+        final_chunks = []
+        # Get appropriate separator to use
+        separator = separators[-1]
+        new_separators = []
+        for i, _s in enumerate(separators):
+            _separator = _s if self._is_separator_regex else re.escape(_s)
+            if _s == "":
+                separator = _s
+                break
+            if re.search(_separator, text):
+                separator = _s
+                new_separators = separators[i + 1:]
+                break
+
+        _separator = separator if self._is_separator_regex else re.escape(separator)
+        splits = _split_text_with_regex(text, _separator, self._keep_separator)
+        lengths = self._batched_length_function(splits)
+
+        # Merge the small splits, recursively splitting the ones that are too long
+        good_splits, good_lengths = [], []
+        _separator = "" if self._keep_separator else separator
+        for s, s_len in zip(splits, lengths):
+            if s_len < self._chunk_size:
+                good_splits.append(s)
+                good_lengths.append(s_len)
+            else:
+                if good_splits:
+                    final_chunks.extend(self._merge_splits(good_splits, _separator, good_lengths))
+                    good_splits, good_lengths = [], []
+                if not new_separators:
+                    final_chunks.append(s)
+                else:
+                    final_chunks.extend(self._split_text(s, new_separators))
+        if good_splits:
+            final_chunks.extend(self._merge_splits(good_splits, _separator, good_lengths))
+        return final_chunks
+
+    def _merge_splits(self, splits, separator, lengths=None):
+        splits = list(splits)
+        if lengths is None:
+            lengths = self._batched_length_function(splits)
+        separator_len = self._length_function(separator)
+
+        docs = []
+        current_doc = deque() # (text, length) pairs
+        total = 0
+        for d, _len in zip(splits, lengths):
+            if total + _len + (separator_len if current_doc else 0) > self._chunk_size:
+                if total > self._chunk_size:
+                    logging.warning(f"Created a chunk of size {total}, which is longer than the specified {self._chunk_size}")
+                if current_doc:
+                    doc = self._join_docs([text for text, _ in current_doc], separator)
+                    if doc is not None:
+                        docs.append(doc)
+                    # Drop leading splits until only the overlap remains and the next split fits
+                    while total > self._chunk_overlap or (
+                        total + _len + (separator_len if current_doc else 0) > self._chunk_size
+                        and total > 0
+                    ):
+                        total -= current_doc[0][1] + (separator_len if len(current_doc) > 1 else 0)
+                        current_doc.popleft()
+            current_doc.append((d, _len))
+            total += _len + (separator_len if len(current_doc) > 1 else 0)
+        doc = self._join_docs([text for text, _ in current_doc], separator)
+        if doc is not None:
+            docs.append(doc)
+        return docs
+
+# Splitters are stateless between calls, so build them once per process
+# Parent: large chunks for the LLM to read. Child: small chunks for precise matching.
+# Parents prefer sentence boundaries over PDF line wraps so context isn't cut mid-sentence.
+PARENT_SPLITTER = BatchedLengthTextSplitter(
+    separators=["\n\n", r"(?<=[.!?])\s+", "\n", " ", ""],
+    is_separator_regex=True,
+    chunk_size=2000,
+    chunk_overlap=200
+)
+CHILD_CHUNK_SIZE = 400
+CHILD_SPLITTER = BatchedLengthTextSplitter(chunk_size=CHILD_CHUNK_SIZE, chunk_overlap=50)
+MIN_CHILD_CHARS = 100 # Smaller children are folded into their neighbour
+MAX_CHILD_CHARS = 450
+
+def merge_tiny(text, chunks, min_size=MIN_CHILD_CHARS, max_size=MAX_CHILD_CHARS):
+    """Fold tiny child chunks of `text` into the previous chunk and hard-split oversized
+    ones, so stragglers don't cost an embedding and a Firestore write of their own.
+
+    Splitter chunks are stripped substrings of `text`, so a merged chunk is the span of
+    `text` covering both. That keeps the overlap and the original separator between them
+    without guessing where one chunk's text ends and the next one's begins."""
+    merged = [] # [start, end] spans of text; a chunk that can't be located is kept as a str
+    search_from = 0
+    for chunk in chunks:
+        start = text.find(chunk, search_from)
+        if start == -1:
+            merged.append(chunk)
+            continue
+        search_from = start + 1
+        end = start + len(chunk)
+        prev = merged[-1] if merged else None
+        if len(chunk) < min_size and isinstance(prev, list) and end - prev[0] <= max_size:
+            prev[1] = max(prev[1], end)
+            continue
+        merged.append([start, end])
+
+    merged = [text[m[0]:m[1]] if isinstance(m, list) else m for m in merged]
+    return [c[i:i + max_size] for c in merged for i in range(0, len(c), max_size)]
@@ -2,14 +2,14 @@ import os
 import json
 import logging
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Flask, request
 from google.cloud import storage
 from google.cloud import firestore
 from google.cloud.firestore_v1.vector import Vector
 from langchain_google_vertexai import VertexAIEmbeddings
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from pypdf import PdfReader
-from io import BytesIO
+from pdf_reader import read_pdf, get_page, PageOutOfRangeError
+from chunking import PARENT_SPLITTER, CHILD_SPLITTER, CHILD_CHUNK_SIZE, merge_tiny
 import base64
 
 app = Flask(__name__)
@@ -21,9 +21,59 @@ db = firestore.Client(project=PROJECT_ID)
 storage_client = storage.Client()
 embeddings = VertexAIEmbeddings(model_name="text-embedding-004", project=PROJECT_ID)
 
-def get_deterministic_id(key_string):
-    """Generate a hash ID to ensure Idempotency [SRS 4.3]"""
-    return hashlib.sha256(key_string.encode("utf-8")).hexdigest()
+# Firestore caps a batch at 500 writes; flush early and commit batches in parallel
+MAX_BATCH_OPS = 400
+EMBED_BATCH_SIZE = 50 # Texts per Vertex AI embedding request
+commit_executor = ThreadPoolExecutor(max_workers=10)
+embed_executor = ThreadPoolExecutor(max_workers=4)
+
+def extend_id_hash(prefix_hash, suffix):
+    """Hash for a deterministic ID to ensure Idempotency [SRS 4.3].
+    Continues a copy of the shared key prefix's hash instead of rehashing the prefix."""
+    id_hash = prefix_hash.copy()
+    id_hash.update(suffix.encode("utf-8"))
+    return id_hash
+
+def flush(batch):
+    """Submit a Firestore batch commit to the shared thread pool."""
+    return commit_executor.submit(batch.commit)
+
+def commit_writes(writes):
+    """Split (ref, data) writes into batches under the Firestore limit and flush
+    each one. Returns the commit futures."""
+    futures = []
+    for start in range(0, len(writes), MAX_BATCH_OPS):
+        batch = db.batch()
+        for ref, data in writes[start:start + MAX_BATCH_OPS]:
+            batch.set(ref, data)
+        futures.append(flush(batch))
+    return futures
+
+def delete_stale(file_path, page_num, parent_ids, child_ids):
+    """Delete this page's parents and children that the latest ingestion didn't write.
+    IDs are by chunk index, so a re-chunked page with fewer chunks would otherwise keep
+    its old higher-index documents. Returns the commit futures."""
+    parents = db.collection("rag_parents")
+    page_parent_ids = {doc.id for doc in parents.where(filter=firestore.FieldFilter("source", "==", file_path))
+                                                .where(filter=firestore.FieldFilter("page", "==", page_num))
+                                                .select(["page"]).stream()}
+    stale_refs = [parents.document(pid) for pid in page_parent_ids - parent_ids]
+
+    # Children of current and stale parents alike; 'in' takes at most 30 values
+    children = db.collection("rag_children")
+    page_parent_ids = sorted(page_parent_ids | parent_ids)
+    for start in range(0, len(page_parent_ids), 30):
+        child_docs = children.where(filter=firestore.FieldFilter("parent_id", "in", page_parent_ids[start:start + 30]))\
+                             .select(["parent_id"]).stream()
+        stale_refs.extend(doc.reference for doc in child_docs if doc.id not in child_ids)
+
+    futures = []
+    for start in range(0, len(stale_refs), MAX_BATCH_OPS):
+        batch = db.batch()
+        for ref in stale_refs[start:start + MAX_BATCH_OPS]:
+            batch.delete(ref)
+        futures.append(flush(batch))
+    return futures
 
 @app.route("/", methods=["POST"])
 def process_task():
@@ -47,72 +97,93 @@ def process_task():
     logging.info(f"Worker processing Page {page_num} of {file_path}")
 
     try:
-        # 1. Download Specific Page
+        # 1. Locate the file
         bucket = storage_client.bucket(bucket_name)
         blob = bucket.blob(file_path)
-        content = blob.download_as_bytes()
-        
+
         # 2. Parse Text (PDF)
-        # Optimization: In a real huge file, we'd use range headers, 
-        # but pypdf requires the whole file structure usually.
-        # Since we are in Cloud Run, memory is cheap.
-        reader = PdfReader(BytesIO(content))
-        page = reader.pages[page_num]
-        raw_text = page.extract_text()
+        # Small files are downloaded whole; large ones are read in cached byte ranges
+        raw_text = read_pdf(blob, lambda reader: get_page(reader, page_num).extract_text())
 
         if not raw_text.strip():
             logging.warning("Empty page text.")
+            # Drop anything a previous ingestion indexed for this page
+            for f in delete_stale(file_path, page_num, set(), set()):
+                f.result()
             return "OK", 200
 
         # 3. Parent Chunking (Context)
         # Large chunks for the LLM to read
-        parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000, chunk_overlap=200)
-        parent_chunks = parent_splitter.split_text(raw_text)
-
-        batch = db.batch()
-        batch_count = 0
-
+        parent_chunks = PARENT_SPLITTER.split_text(raw_text)
+
+        # 4. Child Chunking (Vectors)
+        # Small chunks for precise matching
+        parent_writes = []
+        child_meta = [] # (parent_id, child_id) per child, aligned with child_texts
+        child_texts = []
+        # IDs are sha256("file|page|p_idx") for parents and sha256("file|page|p_idx|c_idx") for children
+        page_hash = hashlib.sha256(f"{file_path}|{page_num}|".encode("utf-8"))
         for p_idx, parent_text in enumerate(parent_chunks):
             # Generate deterministic Parent ID
-            parent_key = f"{file_path}|{page_num}|{p_idx}"
-            parent_id = get_deterministic_id(parent_key)
-            
-            parent_ref = db.collection("rag_parents").document(parent_id)
-            batch.set(parent_ref, {
+            parent_hash = extend_id_hash(page_hash, str(p_idx))
+            parent_id = parent_hash.hexdigest()
+
+            parent_writes.append((db.collection("rag_parents").document(parent_id), {
                 "client_id": client_id,
                 "source": file_path,
                 "page": page_num,
                 "content": parent_text
-            })
-
-            # 4. Child Chunking (Vectors)
-            # Small chunks for precise matching
-            child_splitter = RecursiveCharacterTextSplitter(chunk_size=400, chunk_overlap=50)
-            child_chunks = child_splitter.split_text(parent_text)
-
-            # Embed Batch of Children
-            if child_chunks:
-                vectors = embeddings.embed_documents(child_chunks)
-                
-                for c_idx, child_text in enumerate(child_chunks):
-                    child_key = f"{parent_key}|{c_idx}"
-                    child_id = get_deterministic_id(child_key)
-                    
-                    child_ref = db.collection("rag_children").document(child_id)
-                    batch.set(child_ref, {
-                        "client_id": client_id,
-                        "parent_id": parent_id, # Link back to Parent
-                        "content": child_text,
-                        "embedding": Vector(vectors[c_idx])
-                    })
-                    batch_count += 2 # One parent + one child write
-
-        # Commit to Firestore
-        batch.commit()
+            }))
+
+            # A parent that already fits in one child would split into exactly itself
+            if len(parent_text) <= CHILD_CHUNK_SIZE:
+                child_chunks = [parent_text]
+            else:
+                child_chunks = merge_tiny(parent_text, CHILD_SPLITTER.split_text(parent_text))
+
+            for c_idx, child_text in enumerate(child_chunks):
+                child_id = extend_id_hash(parent_hash, f"|{c_idx}").hexdigest()
+                child_meta.append((parent_id, child_id))
+                child_texts.append(child_text)
+
+        # 5. Embed children in the background while the parents are written
+        embed_futures = [
+            embed_executor.submit(embeddings.embed_documents, child_texts[start:start + EMBED_BATCH_SIZE])
+            for start in range(0, len(child_texts), EMBED_BATCH_SIZE)
+        ]
+        futures = commit_writes(parent_writes)
+
+        vectors = [vector for f in embed_futures for vector in f.result()]
+        child_writes = []
+        for (parent_id, child_id), child_text, vector in zip(child_meta, child_texts, vectors):
+            child_writes.append((db.collection("rag_children").document(child_id), {
+                "client_id": client_id,
+                "parent_id": parent_id, # Link back to Parent
+                "content": child_text,
+                "embedding": Vector(vector)
+            }))
+        futures += commit_writes(child_writes)
+
+        # Wait for every commit before acknowledging the task
+        done, _ = wait(futures)
+        for f in done:
+            f.result() # Re-raise any commit failure
+
+        # 6. Remove documents from an earlier ingestion that these writes didn't replace
+        # (only after the new ones are committed, so the page is never missing from search)
+        parent_ids = {ref.id for ref, _ in parent_writes}
+        child_ids = {child_id for _, child_id in child_meta}
+        for f in delete_stale(file_path, page_num, parent_ids, child_ids):
+            f.result()
         logging.info(f"Indexed Page {page_num}: {len(parent_chunks)} Parents created.")
 
         return "OK", 200
 
+    except PageOutOfRangeError as e:
+        # Retrying can't make the page exist; ack so Pub/Sub doesn't redeliver it forever
+        logging.error(f"Worker skipped {file_path}: {e}")
+        return "OK", 200
+
     except Exception as e:
         logging.error(f"Worker Failed: {e}")
         return f"Error: {e}", 500
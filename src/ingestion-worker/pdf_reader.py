@@ -0,0 +1,172 @@
+import io
+import logging
+from collections import OrderedDict
+from pypdf import PdfReader, PageObject
+from pypdf.errors import PyPdfError
+from pypdf.generic import IndirectObject, NameObject
+
+WHOLE_DOWNLOAD_MAX_BYTES = 32 * 1024 * 1024 # Smaller files are fetched in one GET
+BLOCK_SIZE = 512 * 1024
+MAX_CACHED_BLOCKS = 64 # 32 MiB of cached blocks per open file
+INHERITABLE_PAGE_ATTRIBUTES = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+def read_pdf(blob, read):
+    """Return read(reader) for the PDF stored in a GCS blob.
+
+    Small blobs are downloaded whole and parsed leniently. Larger ones are parsed in
+    strict mode through a BlockCachedBlobReader, so only the byte ranges pypdf touches
+    are fetched (lenient mode seeks to every object to validate the xref table, which
+    would pull the whole file anyway). If the strict parse or the page tree walk fails,
+    fall back to a whole download."""
+    if blob.size is None or blob.generation is None:
+        blob.reload()
+    if blob.size > WHOLE_DOWNLOAD_MAX_BYTES:
+        # PageOutOfRangeError isn't retried; a whole download won't find the page either
+        try:
+            with BlockCachedBlobReader(blob) as fp:
+                return read(PdfReader(fp, strict=True))
+        except (PyPdfError, KeyError, TypeError) as e:
+            logging.warning(f"Ranged read of {blob.name} failed ({e}); downloading it whole")
+    return read(PdfReader(io.BytesIO(blob.download_as_bytes())))
+
+class PageOutOfRangeError(IndexError):
+    """The requested page isn't in the document."""
+
+def count_pages(reader):
+    """Same count as len(reader.pages). For a ranged reader, taken from the page tree
+    root's /Count instead of walking every page object."""
+    if not isinstance(reader.stream, BlockCachedBlobReader):
+        # In memory, so count the pages pypdf actually finds rather than trusting /Count
+        return len(reader.pages)
+    return int(reader.root_object["/Pages"]["/Count"])
+
+def get_page(reader, page_num):
+    """Same page as reader.pages[page_num]. For a ranged reader, found without
+    flattening the page tree.
+
+    pypdf flattens the whole tree on first page access, reading every page object in
+    the file. Over ranged reads this descends from the root instead, skipping earlier
+    subtrees by their /Count, so only the path and its earlier siblings are read."""
+    if not isinstance(reader.stream, BlockCachedBlobReader):
+        # Already in memory, so pypdf's own walk costs nothing extra
+        if page_num >= len(reader.pages):
+            raise PageOutOfRangeError(f"Page {page_num} is out of range")
+        return reader.pages[page_num]
+
+    node = reader.root_object["/Pages"]
+    inherited = {}
+    index = page_num
+    while True:
+        for attr in INHERITABLE_PAGE_ATTRIBUTES:
+            if attr in node:
+                inherited[attr] = node[attr]
+        for kid_ref in node["/Kids"]:
+            kid = kid_ref.get_object()
+            count = kid["/Count"] if "/Kids" in kid else 1
+            if index < count:
+                break
+            index -= count
+        else:
+            raise PageOutOfRangeError(f"Page {page_num} is out of range")
+        if "/Kids" not in kid:
+            break
+        node = kid
+
+    page = PageObject(reader, kid_ref if isinstance(kid_ref, IndirectObject) else None)
+    page.update(kid_ref.get_object())
+    for attr, value in inherited.items():
+        # A page's own value overrides the inherited one
+        if attr not in page:
+            page[NameObject(attr)] = value
+    return page
+
+class BlockCachedBlobReader(io.RawIOBase):
+    """Read-only, seekable view of a GCS blob that fetches fixed-size blocks with
+    ranged GETs and keeps recently used blocks in an LRU.
+
+    pypdf reads the trailer at the end of the file and then jumps back and forth
+    between objects. storage's BlobReader drops its buffer on every backward seek
+    and refetches up to 40 MiB; here those seeks are served from cached blocks."""
+
+    def __init__(self, blob, block_size=BLOCK_SIZE, max_blocks=MAX_CACHED_BLOCKS):
+        self._blob = blob
+        self._size = blob.size
+        # Every block comes from this generation, even if the object is overwritten mid-read
+        self._generation = blob.generation
+        self._block_size = block_size
+        self._max_blocks = max_blocks
+        self._blocks = OrderedDict() # block index -> bytes, least recently used first
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        end = self._size if size is None or size < 0 else min(self._pos + size, self._size)
+        if self._pos >= end:
+            return b""
+        first = self._pos // self._block_size
+        last = (end - 1) // self._block_size
+        data = b"".join(self._get_blocks(first, last))
+        offset = self._pos - first * self._block_size
+        self._pos = end
+        return data[offset:end - first * self._block_size]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def _get_blocks(self, first, last):
+        """Blocks first..last inclusive; each run of missing blocks is one ranged GET."""
+        blocks = {}
+        missing = []
+        for index in range(first, last + 1):
+            if index in self._blocks:
+                blocks[index] = self._blocks[index]
+            else:
+                missing.append(index)
+
+        run_start = 0
+        for i in range(1, len(missing) + 1):
+            if i == len(missing) or missing[i] != missing[i - 1] + 1:
+                blocks.update(self._fetch(missing[run_start], missing[i - 1]))
+                run_start = i
+
+        for index in range(first, last + 1):
+            self._blocks[index] = blocks[index]
+            self._blocks.move_to_end(index)
+        while len(self._blocks) > self._max_blocks:
+            self._blocks.popitem(last=False)
+        return [blocks[index] for index in range(first, last + 1)]
+
+    def _fetch(self, first, last):
+        start = first * self._block_size
+        end = min((last + 1) * self._block_size, self._size) - 1 # inclusive
+        data = self._blob.download_as_bytes(
+            start=start, end=end, checksum=None, if_generation_match=self._generation
+        )
+        return {
+            index: data[(index - first) * self._block_size:(index - first + 1) * self._block_size]
+            for index in range(first, last + 1)
+        }
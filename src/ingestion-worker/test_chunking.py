@@ -0,0 +1,41 @@
+from chunking import CHILD_SPLITTER, MAX_CHILD_CHARS, merge_tiny
+
+FILLER = ("Dosing applies to paediatric patients with normal renal function "
+          "and no hepatic impairment. ") * 4
+
+
+def test_merge_tiny_keeps_text_when_chunks_do_not_overlap():
+    # A paragraph break carries no splitter overlap; "1" must not be taken as one
+    text = FILLER.strip() + " See Table 1\n\n1 mg/kg twice daily for ten days."
+    chunks = CHILD_SPLITTER.split_text(text)
+    assert chunks[-1] == "1 mg/kg twice daily for ten days."
+
+    merged = merge_tiny(text, chunks)
+
+    assert merged[-1].endswith("See Table 1\n\n1 mg/kg twice daily for ten days.")
+
+
+def test_merge_tiny_does_not_duplicate_overlap():
+    text = FILLER.strip() + " Repeat the course once if symptoms persist."
+    chunks = CHILD_SPLITTER.split_text(text)
+    assert len(chunks) == 2 and len(chunks[-1]) < 100
+
+    merged = merge_tiny(text, chunks)
+
+    assert len(merged) == 1
+    assert merged[0] in text
+    assert merged[0].endswith("Repeat the course once if symptoms persist.")
+
+
+def test_merge_tiny_leaves_tiny_chunk_when_merge_would_be_too_long():
+    text = "a" * 448 + " tail"
+    merged = merge_tiny(text, ["a" * 448, "tail"], max_size=MAX_CHILD_CHARS)
+
+    assert merged == ["a" * 448, "tail"]
+
+
+def test_merge_tiny_splits_oversized_chunks():
+    text = "b" * 1000
+    merged = merge_tiny(text, [text], max_size=MAX_CHILD_CHARS)
+
+    assert [len(c) for c in merged] == [450, 450, 100]
@@ -0,0 +1,130 @@
+import io
+import pytest
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, NameObject, NumberObject
+from pdf_reader import BlockCachedBlobReader, PageOutOfRangeError, count_pages, get_page, read_pdf
+
+
+class FakeBlob:
+    """Just enough of storage.Blob for the reader; counts ranged GETs."""
+
+    def __init__(self, data):
+        self.name = "test.pdf"
+        self.size = len(data)
+        self.data = data
+        self.generation = 1
+        self.gets = 0
+        self.whole_downloads = 0
+
+    def download_as_bytes(self, start=None, end=None, checksum="md5", if_generation_match=None):
+        self.gets += 1
+        if start is not None:
+            assert if_generation_match == self.generation
+        if start is None:
+            self.whole_downloads += 1
+            return self.data
+        return self.data[start:end + 1]
+
+
+def make_pdf(pages):
+    writer = PdfWriter()
+    for i in range(pages):
+        writer.add_blank_page(width=200 + i, height=300)
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def make_nested_pdf():
+    """Three pages in the tree [[p0, p1], p2, <empty /Pages>]; /Count matches len(/Kids)
+    at the root even though kid 1 isn't page 1."""
+    data = make_pdf(3)
+    writer = PdfWriter(clone_from=PdfReader(io.BytesIO(data)))
+    root = writer.root_object["/Pages"]
+    kids = list(root["/Kids"])
+
+    def add_node(node_kids):
+        node = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(node_kids),
+            NameObject("/Count"): NumberObject(len(node_kids)),
+            NameObject("/Parent"): root.indirect_reference,
+        }))
+        for kid in node_kids:
+            kid.get_object()[NameObject("/Parent")] = node
+        return node
+
+    root[NameObject("/Kids")] = ArrayObject([add_node(kids[:2]), kids[2], add_node([])])
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def test_block_reader_matches_bytes_io():
+    data = bytes(range(256)) * 40
+    blob = FakeBlob(data)
+    expected = io.BytesIO(data)
+    with BlockCachedBlobReader(blob, block_size=1000, max_blocks=2) as fp:
+        for offset, whence, size in [(0, 0, 10), (-50, 2, 100), (2500, 0, 3000),
+                                     (-200, 1, 1), (9000, 0, -1), (5, 0, 0)]:
+            assert fp.seek(offset, whence) == expected.seek(offset, whence)
+            assert fp.read(size) == expected.read(size)
+
+
+def test_block_reader_reuses_cached_blocks():
+    blob = FakeBlob(b"x" * 4000)
+    with BlockCachedBlobReader(blob, block_size=1000, max_blocks=4) as fp:
+        fp.read(2500)
+        fp.seek(100)
+        fp.read(2000)
+    assert blob.gets == 1
+
+
+@pytest.mark.parametrize("whole_download_max_bytes", [32 * 1024 * 1024, 0])
+def test_get_page_follows_nested_tree(monkeypatch, whole_download_max_bytes):
+    monkeypatch.setattr("pdf_reader.WHOLE_DOWNLOAD_MAX_BYTES", whole_download_max_bytes)
+    data = make_nested_pdf()
+    expected = [page.mediabox for page in PdfReader(io.BytesIO(data)).pages]
+
+    for i in range(3):
+        assert read_pdf(FakeBlob(data), lambda reader: get_page(reader, i).mediabox) == expected[i]
+    with pytest.raises(PageOutOfRangeError):
+        read_pdf(FakeBlob(data), lambda reader: get_page(reader, 3))
+
+
+def test_get_page_and_count_pages_match_pypdf():
+    data = make_pdf(5)
+    reader = PdfReader(io.BytesIO(data))
+
+    assert count_pages(reader) == 5
+    for i in range(5):
+        assert get_page(reader, i).mediabox == reader.pages[i].mediabox
+
+
+def test_count_pages_ignores_wrong_root_count_in_memory():
+    data = make_pdf(3)
+    bad = data.replace(b"/Count 3", b"/Count 5")
+    assert bad != data
+
+    assert read_pdf(FakeBlob(bad), count_pages) == 3
+
+
+def test_read_pdf_uses_ranged_reads_for_large_files(monkeypatch):
+    monkeypatch.setattr("pdf_reader.WHOLE_DOWNLOAD_MAX_BYTES", 0)
+    blob = FakeBlob(make_pdf(3))
+
+    assert read_pdf(blob, count_pages) == 3
+    assert blob.whole_downloads == 0
+
+
+def test_read_pdf_downloads_whole_file_when_ranged_read_fails(monkeypatch):
+    monkeypatch.setattr("pdf_reader.WHOLE_DOWNLOAD_MAX_BYTES", 0)
+    blob = FakeBlob(make_pdf(3))
+
+    def read(reader):
+        if isinstance(reader.stream, BlockCachedBlobReader):
+            raise KeyError("/Kids") # An odd /Pages node in the hand-written walk
+        return count_pages(reader)
+
+    assert read_pdf(blob, read) == 3
+    assert blob.whole_downloads == 1
@@ -1,25 +1,88 @@
 import os
+import re
 import logging
-from flask import Flask, request, jsonify
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from cachetools import TTLCache
+from flask import Flask, Response, request, jsonify, stream_with_context
+from google.cloud import aiplatform_v1
 from google.cloud import firestore
+from google.protobuf import json_format, struct_pb2
 from google.cloud.firestore_v1.vector import Vector
 from google.cloud.firestore_v1.base_vector_query import DistanceMeasure
-from langchain_google_vertexai import VertexAIEmbeddings, ChatVertexAI
+from langchain_google_vertexai import ChatVertexAI
 from langchain.prompts import ChatPromptTemplate
-from google.cloud import firestore as fs_module # Used for ArrayUnion in history save
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
 # --- Configuration ---
 PROJECT_ID = os.environ.get("GCP_PROJECT", "test-rag-backend-v4")
+LOCATION = os.environ.get("GCP_LOCATION", "us-central1")
+EMBEDDING_ENDPOINT = f"projects/{PROJECT_ID}/locations/{LOCATION}/publishers/google/models/text-embedding-004"
 CHAT_HISTORY_COLLECTION = "rag_chat_history" 
 MAX_HISTORY_TURNS = 4 # Retrieve last 4 turns 
+# Greetings/acknowledgements with nothing else in them
+SMALL_TALK_PATTERN = re.compile(r"(hi|hello|hey|thanks|thank you|thx|ok|okay|great|bye)[\s!.,]*", re.IGNORECASE)
 
 # Models and Clients
 db = firestore.Client(project=PROJECT_ID)
-embeddings = VertexAIEmbeddings(model_name="text-embedding-004", project=PROJECT_ID)
+# Query embeddings go straight to Vertex AI over one long-lived gRPC channel
+prediction_client = aiplatform_v1.PredictionServiceClient(
+    client_options={"api_endpoint": f"{LOCATION}-aiplatform.googleapis.com"},
+    transport="grpc"
+)
 llm = ChatVertexAI(model_name="gemini-2.5-pro", project=PROJECT_ID, temperature=0.1)
+# Runs the query embedding while the request thread reads chat history (sized to gunicorn's 8 threads)
+query_executor = ThreadPoolExecutor(max_workers=8)
+# Hot parent chunks by parent_id; TTLCache isn't thread-safe, so guard it with a lock
+parent_cache = TTLCache(maxsize=4096, ttl=300)
+parent_cache_lock = threading.Lock()
+
+def warm_up():
+    """Open the Firestore gRPC channel at startup so the first /query doesn't pay for it."""
+    try:
+        db.collection("rag_children").limit(1).get()
+    except Exception as e:
+        logging.warning(f"Firestore warm-up failed: {e}")
+
+warm_up()
+
+def embed_query(query):
+    """Embed a search query with text-embedding-004, tagged RETRIEVAL_QUERY to pair
+    with the RETRIEVAL_DOCUMENT embeddings written at ingestion."""
+    instance = json_format.ParseDict({"content": query, "task_type": "RETRIEVAL_QUERY"}, struct_pb2.Value())
+    response = prediction_client.predict(endpoint=EMBEDDING_ENDPOINT, instances=[instance])
+    return list(response.predictions[0]["embeddings"]["values"])
+
+@lru_cache(maxsize=1024)
+def embed_normalized_query(normalized_query):
+    """Embed a normalized query. Cached so repeated questions skip the Vertex AI call;
+    returns a tuple so cached vectors can't be mutated by callers."""
+    return tuple(embed_query(normalized_query))
+
+def normalize_query(query):
+    """Whitespace-insensitive cache key for a query. Case is kept because the key is also
+    the text that gets embedded, and case carries meaning here (e.g. "ALL" vs "all")."""
+    return " ".join(query.split())
+
+def is_small_talk(query):
+    """True if the query is a bare greeting or acknowledgement with no retrieval intent."""
+    return SMALL_TALK_PATTERN.fullmatch(query.strip()) is not None
+
+def save_history(messages_ref, user_query, query_ts, answer):
+    """Add the user/assistant turn to the session's messages subcollection in one commit.
+    Committed before the response completes: Cloud Run throttles CPU once it's sent."""
+    batch = db.batch()
+    batch.set(messages_ref.document(), {"role": "user", "content": user_query, "ts": query_ts})
+    batch.set(messages_ref.document(), {
+        "role": "assistant",
+        "content": answer,
+        "ts": datetime.now(timezone.utc)
+    })
+    batch.commit()
 
 @app.route("/query", methods=["POST"])
 def handle_query():
@@ -32,43 +95,66 @@ def handle_query():
     session_id = data.get("session_id", "default_session") # Use session_id for memory
 
     try:
+        # Small talk needs no documents, so skip the embedding and Firestore round-trips
+        query_ts = datetime.now(timezone.utc)
+        vector_future = None
+        if not is_small_talk(user_query):
+            # Independent of the history read below, so embed concurrently
+            vector_future = query_executor.submit(embed_normalized_query, normalize_query(user_query))
+
         # --- 1. Retrieve Chat History ---
-        history_ref = db.collection(CHAT_HISTORY_COLLECTION).document(session_id)
-        history_doc = history_ref.get()
+        # One document per message under the session, so history never grows a single doc
+        messages_ref = db.collection(CHAT_HISTORY_COLLECTION).document(session_id).collection("messages")
+        # Get last N turns (prevents context window overflow)
+        recent_msgs = messages_ref.order_by("ts", direction=firestore.Query.DESCENDING)\
+                                  .limit(MAX_HISTORY_TURNS * 2).stream()
         past_conversation = ""
-        
-        if history_doc.exists:
-            # Get last N turns (prevents context window overflow) 
-            past_msgs = history_doc.to_dict().get("messages", [])[-MAX_HISTORY_TURNS:]
-            for msg in past_msgs:
-                past_conversation += f"{msg['role']}: {msg['content']}\n"
+        for msg_doc in reversed(list(recent_msgs)):
+            msg = msg_doc.to_dict()
+            past_conversation += f"{msg['role']}: {msg['content']}\n"
         
         # 2. Vector Search (Parent-Child Logic remains the same)
-        query_vector = embeddings.embed_query(user_query)
-        collection = db.collection("rag_children")
-        
-        # Filter by client_id for security
-        results = collection.where(filter=firestore.FieldFilter("client_id", "==", client_id))\
-                            .find_nearest(
-                                vector_field="embedding",
-                                query_vector=Vector(query_vector),
-                                distance_measure=DistanceMeasure.COSINE,
-                                limit=7,
-                                distance_result_field="distance"
-                            ).get()
-
-        if not results:
-            # If no context found, still use LLM with history to provide a fallback answer
-            context_text = "No relevant documents found."
+        if vector_future is None:
+            context_text = "No retrieval performed."
         else:
-            parent_ids = set(doc.to_dict()["parent_id"] for doc in results)
-            parent_refs = [db.collection("rag_parents").document(pid) for pid in parent_ids]
-            parent_docs = db.get_all(parent_refs)
+            query_vector = list(vector_future.result())
+            collection = db.collection("rag_children")
+        
+            # Filter by client_id for security
+            # Only parent_id is needed, so don't ship each child's 768-float vector back
+            results = collection.where(filter=firestore.FieldFilter("client_id", "==", client_id))\
+                                .select(["parent_id"])\
+                                .find_nearest(
+                                    vector_field="embedding",
+                                    query_vector=Vector(query_vector),
+                                    distance_measure=DistanceMeasure.COSINE,
+                                    limit=7,
+                                    distance_result_field="distance"
+                                ).get()
+
+            if not results:
+                # If no context found, still use LLM with history to provide a fallback answer
+                context_text = "No relevant documents found."
+            else:
+                parent_ids = set(doc.to_dict()["parent_id"] for doc in results)
+                # Serve popular parents from the cache and only fetch the misses
+                with parent_cache_lock:
+                    cached = {pid: parent_cache.get(pid) for pid in parent_ids}
+                parent_chunks = [chunk for chunk in cached.values() if chunk is not None]
+                missing_ids = [pid for pid, chunk in cached.items() if chunk is None]
+
+                if missing_ids:
+                    # One query for all parents (limit=7 stays well under the 30-value 'in' cap)
+                    parents = db.collection("rag_parents")
+                    parent_refs = [parents.document(pid) for pid in missing_ids]
+                    parent_docs = parents.where(filter=firestore.FieldFilter("__name__", "in", parent_refs)).stream()
+                    fetched = {p_doc.id: p_doc.to_dict() for p_doc in parent_docs}
+                    with parent_cache_lock:
+                        parent_cache.update(fetched)
+                    parent_chunks.extend(fetched.values())
             
-            context_text = ""
-            for p_doc in parent_docs:
-                if p_doc.exists:
-                    chunk = p_doc.to_dict()
+                context_text = ""
+                for chunk in parent_chunks:
                     context_text += f"\n[Source: {chunk['source']}, Page: {chunk['page']}]\n{chunk['content']}\n"
 
         # 3. Generate Answer with Gemini 2.5
@@ -89,11 +175,37 @@ def handle_query():
         """)
         
         chain = prompt | llm
-        response = chain.invoke({
+        chain_input = {
             "context": context_text, 
             "history": past_conversation if past_conversation else "No previous conversation history.",
             "question": user_query
-        })
+        }
+
+        if data.get("stream"):
+            # Send the answer as plain text chunks while Gemini generates it
+            def generate():
+                answer = ""
+                try:
+                    for chunk in chain.stream(chain_input):
+                        answer += chunk.content
+                        yield chunk.content
+                except Exception as e:
+                    # Headers are already sent, so report the failure in the body
+                    logging.error(f"Streaming Error: {e}")
+                    yield "\n\nError generating the rest of the answer."
+                    return
+
+                # --- 4. Save State ---
+                # Still inside the response, so the instance keeps its CPU until this commits
+                try:
+                    save_history(messages_ref, user_query, query_ts, answer)
+                except Exception as e:
+                    # The answer is already delivered; don't append an error to it
+                    logging.error(f"History save failed: {e}")
+
+            return Response(stream_with_context(generate()), mimetype="text/plain")
+
+        response = chain.invoke(chain_input)
         
         final_response = {
             "answer": response.content,
@@ -101,15 +213,7 @@ def handle_query():
         }
 
         # --- 4. Save State ---
-        # Append the new user/assistant messages to the history document
-        new_messages = [
-            {"role": "user", "content": user_query},
-            {"role": "assistant", "content": response.content}
-        ]
-        
-        history_ref.set({
-            "messages": fs_module.ArrayUnion(new_messages)
-        }, merge=True) # merge=True ensures we only update the array field
+        save_history(messages_ref, user_query, query_ts, response.content)
         
         return jsonify(final_response), 200
 